@@ -77,30 +77,80 @@ def delete_tpu(name, zone):
     return response.json()
 
 
-def wait_til(name, zone, state):
+def list_tpus(zone):
+    headers = {
+        'Authorization': f'Bearer {get_bearer()}',
+    }
+
+    # the listing is paged, follow nextPageToken so every node is returned
+    nodes = []
+    params = {}
+
     while True:
-        ret = check_tpu(name, zone)
+        response = requests.get(
+            f'https://tpu.googleapis.com/v2alpha1/projects/{get_project()}/locations/{zone}/nodes',
+            headers=headers, params=params)
+
+        ret = response.json()
+        if "error" in ret:
+            return ret
+
+        nodes += ret.get("nodes", [])
+
+        if not ret.get("nextPageToken"):
+            return {"nodes": nodes}
+
+        params = {"pageToken": ret["nextPageToken"]}
+
 
-        print(ret)
+# True when the node has reached the expected state, False when it never will (error or terminated), None otherwise
+def tpu_state_matches(ret, state):
+    if "error" in ret:
+        return False
 
-        matches = True
-        for k, expected_v in state.items():
-            if k not in ret:
-                matches = False
-                continue
-            if ret[k] != expected_v:
-                matches = False
+    if ret.get("state") == "TERMINATED":
+        return False
+
+    if all(ret.get(k) == expected_v for k, expected_v in state.items()):
+        return True
+
+    return None
+
+
+def wait_til(name, zone, state):
+    return wait_til_many([name], zone, state)
+
+
+# polls all the nodes with a single list call per round, backing off exponentially between rounds
+def wait_til_many(names, zone, state, min_sleep=2, max_sleep=30):
+    waiting = set(names)
+    sleep = min_sleep
+
+    while True:
+        ret = list_tpus(zone)
 
         if "error" in ret:
+            print(ret)
             return False
 
-        if ret["state"] == "TERMINATED":
-            return False
+        nodes = {node["name"].split("/")[-1]: node for node in ret.get("nodes", [])}
+
+        for name in list(waiting):
+            # a node that was created but doesn't show up has gone away
+            node = nodes.get(name, {"error": f"{name} not found"})
+            print(node)
+
+            matches = tpu_state_matches(node, state)
+            if matches is False:
+                return False
+            if matches:
+                waiting.remove(name)
 
-        if matches:
+        if not waiting:
             return True
 
-        time.sleep(1)
+        time.sleep(sleep)
+        sleep = min(sleep * 2, max_sleep)
 
 
 def get_connection(
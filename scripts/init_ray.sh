@@ -6,4 +6,4 @@ sudo mkdir /dev/shm
 sudo mount -t tmpfs -o size=100g tmpfs /dev/shm
 
 sudo pip install --upgrade jaxlib==0.1.59
-sudo pip install --upgrade jax ray fabric dataclasses optax git+https://github.com/deepmind/dm-haiku
\ No newline at end of file
+sudo pip install --upgrade jax ray pygloo fabric dataclasses optax git+https://github.com/deepmind/dm-haiku
\ No newline at end of file
@@ -12,8 +12,8 @@ import optax
 import ray
 from typing import Optional
 
-from .swarm_layer import save_checkpoint, load_checkpoint, opt_state, run_threads, run_function, NetworkPrecision, \
-    quantize, dequantize, init_fn
+from .swarm_layer import AsyncCheckpointer, restore_checkpoint, warm_opt, run_threads, run_function, NetworkPrecision, \
+    quantize, dequantize, init_fn, AsyncOptimizer, join_replica_group
 
 
 def layer_norm(x: jnp.ndarray, name: Optional[str] = None) -> jnp.ndarray:
@@ -24,6 +24,90 @@ def layer_norm(x: jnp.ndarray, name: Optional[str] = None) -> jnp.ndarray:
                         name=name)(x)
 
 
+# The transforms and pmapped functions live at module level with the shape defining arguments static, so every
+# actor in a process shares one trace and compile per (shape, vocab, d_model) instead of closing over them per actor.
+@functools.lru_cache()
+def embed_transform(vocab: int, d_model: int) -> hk.Transformed:
+    def embed_forward(x):
+        embed_init = hk.initializers.TruncatedNormal(stddev=0.02)
+
+        seq_length = x.shape[1]
+        positional_embeddings = hk.get_parameter('pos_embs', [seq_length, d_model], init=embed_init)
+
+        o = hk.Embed(vocab, d_model, w_init=embed_init, name="embedding")(x) + positional_embeddings
+
+        return o
+
+    return hk.transform(embed_forward)
+
+
+@functools.partial(jax.pmap, static_broadcasted_argnums=(2, 3))
+def embed_fwd_fn(obs, params, vocab, d_model):
+    out = embed_transform(vocab, d_model).apply(params, None, obs)
+
+    return out
+
+
+@functools.partial(jax.pmap, donate_argnums=(1, 2), static_broadcasted_argnums=(4, 5))
+def embed_grad_fn(obs, y_dy, acc, params, vocab, d_model):
+    y, dy = y_dy
+
+    y_new, vjpfun = jax.vjp(embed_transform(vocab, d_model).apply, params, None, obs)
+    weights_grad, _, _ = vjpfun(dy)
+    diff = jnp.square(y - y_new).mean()
+    cos_err = jnp.abs(1.0 - jnp.dot(y_new.flatten(), y.flatten()) / (
+            jnp.linalg.norm(y.flatten()) * jnp.linalg.norm(y_new.flatten())))
+
+    new_acc = jax.tree_multimap(operator.add, acc, weights_grad)
+    return diff, cos_err, new_acc
+
+
+def debed_forward(x, vocab: int):
+    x = layer_norm(x)
+
+    return hk.Linear(vocab)(x)
+
+
+# the forward only depends on vocab, so a different loss_scale doesn't trigger another compile of it
+@functools.lru_cache()
+def proj_transform(vocab: int) -> hk.Transformed:
+    return hk.transform(functools.partial(debed_forward, vocab=vocab))
+
+
+@functools.lru_cache()
+def proj_loss_transform(vocab: int, loss_scale: float) -> hk.Transformed:
+    def debed_loss(x, target):
+        logits = debed_forward(x, vocab)
+
+        assert logits.shape == target.shape + (vocab,)
+
+        # cross entropy as logsumexp minus the gathered target logit, without materializing a one-hot target
+        lse = jax.nn.logsumexp(logits, axis=-1)
+        target_logits = jnp.take_along_axis(logits, target[..., None].astype(jnp.int32), axis=-1)[..., 0]
+
+        loss = jnp.mean(lse - target_logits) * loss_scale
+
+        return loss
+
+    return hk.transform(debed_loss)
+
+
+@functools.partial(jax.pmap, static_broadcasted_argnums=2)
+def debed_fwd_fn(target, params, vocab):
+    out = proj_transform(vocab).apply(params, None, target)
+
+    return out
+
+
+@functools.partial(jax.pmap, donate_argnums=(0, 2), static_broadcasted_argnums=(4, 5))
+def debed_grad_fn(hidden, target, acc, params, vocab, loss_scale):
+    loss, vjpfun = jax.vjp(proj_loss_transform(vocab, loss_scale).apply, params, None, hidden, target)
+    weights_grad, _, x_grad, _ = vjpfun(np.ones((), dtype=hidden.dtype))
+
+    new_acc = jax.tree_multimap(operator.add, acc, weights_grad)
+    return hidden, x_grad, loss, new_acc
+
+
 @ray.remote(resources={"tpu": 1})
 class EmbeddingLayer(object):
     def __init__(self, obs, vocab: int, d_model: int, optimizer: optax.GradientTransformation,
@@ -37,64 +121,35 @@ class EmbeddingLayer(object):
         self.devices = jax.local_device_count()
         print("done jax init")
 
-        def embed_forward(x):
-            embed_init = hk.initializers.TruncatedNormal(stddev=0.02)
-
-            seq_length = x.shape[1]
-            positional_embeddings = hk.get_parameter('pos_embs', [seq_length, d_model], init=embed_init)
-
-            o = hk.Embed(vocab, d_model, w_init=embed_init, name="embedding")(x) + positional_embeddings
-
-            return o
-
-        self.embed_fwd_fn = hk.transform(embed_forward)
         master_rng = jax.random.PRNGKey(random.getrandbits(32))
 
-        @functools.partial(jax.pmap)
-        def embed_fwd_fn(obs, params):
-            out = self.embed_fwd_fn.apply(params, None, obs)
-
-            return out
-
-        @functools.partial(jax.pmap, donate_argnums=(1, 2))
-        def embed_grad_fn(obs, y_dy, acc, params):
-            y, dy = y_dy
-
-            y_new, vjpfun = jax.vjp(self.embed_fwd_fn.apply, params, None, obs)
-            weights_grad, _, _ = vjpfun(dy)
-            diff = jnp.square(y - y_new).mean()
-            cos_err = jnp.abs(1.0 - jnp.dot(y_new.flatten(), y.flatten()) / (
-                    jnp.linalg.norm(y.flatten()) * jnp.linalg.norm(y_new.flatten())))
-
-            new_acc = jax.tree_multimap(operator.add, acc, weights_grad)
-            return diff, cos_err, new_acc
-
         # we call all the functions here to trigger jit at init
-        self.state = init_fn(master_rng, obs, self.embed_fwd_fn.init, optimizer)
+        self.state = init_fn(master_rng, obs, embed_transform(vocab, d_model).init, optimizer)
 
         num_params = hk.data_structures.tree_size(self.state["params"])
         print(f'Param count = {num_params}')
 
-        self.embed_fwd = embed_fwd_fn
-        e = self.embed_fwd(obs, self.state["params"])
+        e = embed_fwd_fn(obs, self.state["params"], vocab, d_model)
 
-        self.embed_grad = embed_grad_fn
-        _, _, new_acc = self.embed_grad(obs, (e, e), self.state["grad_acc"], self.state["params"])
-        self.state["grad_acc"] = new_acc
+        # warm up on a throwaway accumulator and don't apply the opt step so the initial state is kept as is
+        embed_grad_fn(obs, (e, e), jax.tree_map(jnp.zeros_like, self.state["grad_acc"]),
+                      self.state["params"], vocab, d_model)
 
-        self.state = opt_state(self.state, self.optimizer)
-        self.state = init_fn(master_rng, obs, self.embed_fwd_fn.init, optimizer)
+        warm_opt(self.state, self.optimizer)
 
+        self.async_opt = AsyncOptimizer(self.optimizer)
+        self.checkpointer = AsyncCheckpointer()
         self.init = False
 
     def run(self):
         def forward(obs, state):
-            return quantize(self.embed_fwd(obs, state["params"]), self.precision.fwd_act)
+            return quantize(embed_fwd_fn(obs, state["params"], self.vocab, self.d_model), self.precision.fwd_act)
 
         def backward(y_dy, obs, state):
             y, dy = y_dy
             y_dy = (dequantize(y, "float32"), dequantize(dy, "float32"))
-            diff, cos_err, new_grad_acc = self.embed_grad(obs, y_dy, state["grad_acc"], state["params"])
+            diff, cos_err, new_grad_acc = embed_grad_fn(obs, y_dy, state["grad_acc"], state["params"], self.vocab,
+                                                        self.d_model)
             state["grad_acc"] = new_grad_acc
             state["grad_count"] = state["grad_count"] + 1
 
@@ -106,21 +161,24 @@ class EmbeddingLayer(object):
         self.bwd_q = Queue(2)
         self.init = True
 
-        run_threads(self.state, self.fwd_q, self.bwd_q, 2, forward, backward)
+        run_threads(self.state, self.fwd_q, self.bwd_q, forward, backward)
 
-    @ray.method(num_returns=2)
     def embed_forward(self, obs):
         while not self.init:
             time.sleep(0.1)
-        return run_function(self.fwd_q, obs), None
+        return run_function(self.fwd_q, obs)
 
     def embed_grad(self, obs, y_dy):
         while not self.init:
             time.sleep(0.1)
         return run_function(self.bwd_q, y_dy, obs)
 
+    def join_group(self, world_size, rank, group_name):
+        self.state = join_replica_group(self.state, world_size, rank, group_name)
+        self.async_opt.group = (world_size, group_name)
+
     def opt(self):
-        self.state = opt_state(self.state, self.optimizer)
+        self.state = self.async_opt.step(self.state)
 
     def get_params(self):
         return self.state["params"]
@@ -129,10 +187,17 @@ class EmbeddingLayer(object):
         return self.state["grad_acc"]
 
     def save(self, path, epoch):
-        save_checkpoint(self.state, path, epoch)
+        # saves the params the last batch ran with, applying the in flight step here would put this replica a step
+        # ahead of the other replicas of the stage
+        self.checkpointer.save(self.state, path, epoch)
+
+    # blocks until the last save is written, raising its error if it failed
+    def flush(self):
+        self.checkpointer.wait()
 
     def load(self, path):
-        ckpt = load_checkpoint(path)
+        self.checkpointer.wait()
+        ckpt = restore_checkpoint(path, self.state)
 
         if ckpt:
             self.state = ckpt
@@ -151,68 +216,34 @@ class ProjLayer(object):
 
         data = dequantize(data, "float32")
 
-        def debed_forward(x):
-            x = layer_norm(x)
-
-            return hk.Linear(vocab)(x)
-
-        def debed_loss(x, target):
-            logits = debed_forward(x)
-            target_onehot = jax.nn.one_hot(target, vocab)
-
-            assert logits.shape == target_onehot.shape
-
-            loss = -jnp.sum(target_onehot * jax.nn.log_softmax(logits), axis=-1)
-            loss = jnp.mean(loss) * self.loss_scale
-
-            return loss
-
-        self.proj_fwd_fn = hk.transform(debed_forward)
-        self.proj_loss_fn = hk.transform(debed_loss)
-
         master_rng = jax.random.PRNGKey(random.getrandbits(32))
 
-        @functools.partial(jax.pmap)
-        def debed_fwd_fn(target, params):
-            out = self.proj_fwd_fn.apply(params, None, target)
-
-            return out
-
-        @functools.partial(jax.pmap, donate_argnums=(0, 2))
-        def debed_grad_fn(hidden, target, acc, params):
-            loss, vjpfun = jax.vjp(self.proj_loss_fn.apply, params, None, hidden, target)
-            weights_grad, _, x_grad, _ = vjpfun(np.ones((), dtype=hidden.dtype))
-
-            new_acc = jax.tree_multimap(operator.add, acc, weights_grad)
-            return hidden, x_grad, loss, new_acc
-
         # we call all the functions here to trigger jit at init
-        self.state = init_fn(master_rng, data, self.proj_fwd_fn.init, optimizer)
+        self.state = init_fn(master_rng, data, proj_transform(vocab).init, optimizer)
 
         num_params = hk.data_structures.tree_size(self.state["params"])
         print(f'Param count = {num_params}')
 
-        self.debed_fwd = debed_fwd_fn
-        self.debed_fwd(jnp.zeros_like(data), self.state["params"])
+        debed_fwd_fn(jnp.zeros_like(data), self.state["params"], vocab)
 
-        self.debed_grad = debed_grad_fn
-        _, _, _, new_acc = self.debed_grad(jnp.zeros_like(data), np.ones_like(data).mean(axis=-1),
-                                           self.state["grad_acc"],
-                                           self.state["params"])
-        self.state["grad_acc"] = new_acc
+        # warm up on a throwaway accumulator and don't apply the opt step so the initial state is kept as is
+        debed_grad_fn(jnp.zeros_like(data), np.ones_like(data).mean(axis=-1),
+                      jax.tree_map(jnp.zeros_like, self.state["grad_acc"]),
+                      self.state["params"], vocab, loss_scale)
 
-        self.state = opt_state(self.state, self.optimizer)
-        self.state = init_fn(master_rng, jnp.zeros_like(data), self.proj_fwd_fn.init, optimizer)
+        warm_opt(self.state, self.optimizer)
 
+        self.async_opt = AsyncOptimizer(self.optimizer)
+        self.checkpointer = AsyncCheckpointer()
         self.init = False
 
     def run(self):
         def forward(h, state):
-            return self.debed_fwd(dequantize(h, "float32"), state["params"])
+            return debed_fwd_fn(dequantize(h, "float32"), state["params"], self.vocab)
 
         def backward(h, targets, state):
-            hidden, x_grad, loss, new_acc = self.debed_grad(dequantize(h, "float32"), targets, state["grad_acc"],
-                                                            state["params"])
+            hidden, x_grad, loss, new_acc = debed_grad_fn(dequantize(h, "float32"), targets, state["grad_acc"],
+                                                          state["params"], self.vocab, self.loss_scale)
             state["grad_acc"] = new_acc
             state["grad_count"] = state["grad_count"] + 1
 
@@ -224,7 +255,7 @@ class ProjLayer(object):
         self.bwd_q = Queue(2)
         self.init = True
 
-        run_threads(self.state, self.fwd_q, self.bwd_q, 2, forward, backward)
+        run_threads(self.state, self.fwd_q, self.bwd_q, forward, backward)
 
     @ray.method(num_returns=2)
     def debed_forward(self, h):
@@ -238,8 +269,12 @@ class ProjLayer(object):
             time.sleep(0.1)
         return run_function(self.bwd_q, h, targets)
 
+    def join_group(self, world_size, rank, group_name):
+        self.state = join_replica_group(self.state, world_size, rank, group_name)
+        self.async_opt.group = (world_size, group_name)
+
     def opt(self):
-        self.state = opt_state(self.state, self.optimizer)
+        self.state = self.async_opt.step(self.state)
 
     def get_params(self):
         return self.state["params"]
@@ -248,10 +283,17 @@ class ProjLayer(object):
         return self.state["grad_acc"]
 
     def save(self, path, epoch):
-        save_checkpoint(self.state, path, epoch)
+        # saves the params the last batch ran with, applying the in flight step here would put this replica a step
+        # ahead of the other replicas of the stage
+        self.checkpointer.save(self.state, path, epoch)
+
+    # blocks until the last save is written, raising its error if it failed
+    def flush(self):
+        self.checkpointer.wait()
 
     def load(self, path):
-        ckpt = load_checkpoint(path)
+        self.checkpointer.wait()
+        ckpt = restore_checkpoint(path, self.state)
 
         if ckpt:
             self.state = ckpt
@@ -1,3 +1,5 @@
+import functools
+
 import haiku as hk
 import jax
 import jax.numpy as jnp
@@ -5,6 +7,12 @@ import numpy as np
 from typing import Optional, Callable
 
 
+@functools.lru_cache(maxsize=8)
+def causal_mask(seq_len: int) -> np.ndarray:
+    """Lower triangular [seq_len, seq_len] mask, built once per sequence length and shared by every layer."""
+    return np.tril(np.ones((seq_len, seq_len), dtype=bool))
+
+
 class MultiHeadAttentionFixed(hk.Module):
     """Multi-headed attention mechanism.
 
@@ -35,20 +43,19 @@ class MultiHeadAttentionFixed(hk.Module):
             mask: Optional[jnp.ndarray] = None,
     ) -> jnp.ndarray:
         """Compute (optionally masked) MHA with queries, keys & values."""
-        query_heads = self._linear_projection(query, self.query_size, "query")
-        key_heads = self._linear_projection(query, self.key_size, "key")
-        value_heads = self._linear_projection(query, self.value_size, "value")
+        query_heads, key_heads, value_heads = self._qkv_projection(query)
 
-        sqrt_key_size = np.sqrt(self.key_size)
-        query_heads = query_heads / sqrt_key_size
+        # a python float scale is weakly typed, so bfloat16 queries stay bfloat16 (a numpy scalar would promote them to
+        # float32), and the multiply fuses into the query projection's output
+        query_heads = query_heads * float(1. / np.sqrt(self.key_size))
 
         attention_logits = jnp.einsum("bthd,bThd->bhtT", query_heads, key_heads)
 
         seq_len = query.shape[1]
-        causal_mask = np.tril(np.ones((seq_len, seq_len)))
-        mask = mask * causal_mask if mask is not None else causal_mask
+        causal = causal_mask(seq_len)
+        mask = jnp.logical_and(mask, causal) if mask is not None else causal
 
-        attention_logits -= 1e10 * (1. - mask)
+        attention_logits = jnp.where(mask, attention_logits, -1e10)
 
         attention_weights = jax.nn.softmax(attention_logits)
         attention = jnp.einsum("bhtT,bThd->bthd", attention_weights, value_heads)
@@ -58,14 +65,15 @@ class MultiHeadAttentionFixed(hk.Module):
         return hk.Linear(self.model_size, w_init=self.w_init)(attention_vec)
 
     @hk.transparent
-    def _linear_projection(
-            self,
-            x: jnp.ndarray,
-            head_size: int,
-            name: Optional[str] = None
-    ) -> jnp.ndarray:
-        y = hk.Linear(self.num_heads * head_size, w_init=self.w_init, name=name)(x)
-        return y.reshape((*x.shape[:2], self.num_heads, head_size))
+    def _qkv_projection(self, x: jnp.ndarray):
+        # one [d_model, heads * (q + k + v)] weight instead of three, so the projections are a single matmul
+        # (VarianceScaling only looks at fan in, so the init matches three separate linears)
+        sizes = [self.query_size, self.key_size, self.value_size]
+        y = hk.Linear(self.num_heads * sum(sizes), w_init=self.w_init, name="qkv")(x)
+
+        splits = np.cumsum([self.num_heads * size for size in sizes])[:-1]
+        return [h.reshape((*x.shape[:2], self.num_heads, size))
+                for h, size in zip(jnp.split(y, splits, axis=-1), sizes)]
 
 
 class DenseBlock(hk.Module):
@@ -89,11 +97,13 @@ class DenseBlock(hk.Module):
 
 class SwarmModel:
     def __init__(self, vocab: int, d_model: int,
-                 rev_init: Callable, rev_layers: int):
+                 rev_init: Callable, rev_layers: int, rev_period: int = 1):
         self.vocab = vocab
         self.d_model = d_model
         self.rev_init = rev_init
         self.rev_layers = rev_layers
+        # rev_init(i) and rev_init(i + rev_period) build layers with the same structure, which lets them be stacked
+        self.rev_period = rev_period
 
 
 n_layer = 6
@@ -130,12 +140,14 @@ SwarmCharTransformer = SwarmModel(
     vocab=256,
     d_model=512,
     rev_init=char_layer_init,
-    rev_layers=n_layer
+    rev_layers=n_layer,
+    rev_period=2
 )
 
 SwarmCharTransformerBig = SwarmModel(
     vocab=256,
     d_model=2048,
     rev_init=char_layer_init,
-    rev_layers=n_layer
+    rev_layers=n_layer,
+    rev_period=2
 )
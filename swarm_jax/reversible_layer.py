@@ -9,30 +9,21 @@ import jax
 import jax.numpy as jnp
 import optax
 import ray
-from typing import Callable
+from typing import Callable, List, Sequence, Tuple
 
-from .swarm_layer import save_checkpoint, load_checkpoint, opt_state, run_threads, run_function, NetworkPrecision, \
-    quantize, dequantize, init_fn
+from .swarm_layer import AsyncCheckpointer, restore_checkpoint, warm_opt, run_threads, run_function, NetworkPrecision, \
+    quantize, dequantize, init_fn, AsyncOptimizer, join_replica_group, cast_tree, float_types
 
 
-@ray.remote(resources={"tpu": 1})
-class ReversibleLayer(object):
-    def __init__(
-            self,
-            layer_init: Callable,
-            layer: int,
-            data: jnp.ndarray,
-            optimizer: optax.GradientTransformation,
-            precision: NetworkPrecision
-    ):
-        self.layer = layer
-        self.optimizer = optimizer
-        self.precision = precision
-
-        data = dequantize(data, "float32")
-
-        def forward(x):
-            f, g = layer_init(layer)
+# Each block of `period` layers is built from layer indices 0..period-1, which have the same structure as any other
+# block (that is what the model's rev_period means). So every block, and every group actor, uses the same parameter
+# names and traces the same program: block params can be stacked along a leading axis and scanned over. Each actor
+# still compiles that program itself, the scan keeps it to one block's worth of ops however many blocks it holds.
+@functools.lru_cache()
+def block_transforms(layer_init: Callable, period: int) -> Tuple[hk.Transformed, List[Tuple[hk.Transformed, ...]]]:
+    def forward(x):
+        for i in range(period):
+            f, g = layer_init(i)
 
             hidden = x.shape[-1]
             x1 = x[:, :, :hidden // 2]
@@ -44,66 +35,143 @@ class ReversibleLayer(object):
             assert x1.shape == y1.shape
             assert x2.shape == y2.shape
 
-            return jnp.concatenate((y1, y2), axis=-1)
+            x = jnp.concatenate((y1, y2), axis=-1)
 
-        def reverse(y):
-            f, g = layer_init(layer)
+        return x
 
-            hidden = y.shape[-1]
-            y1 = y[:, :, :hidden // 2]
-            y2 = y[:, :, hidden // 2:]
+    # f and g of each layer in the block as separate functions of the (shared) block params, so that the backward pass
+    # can take the vjp of each one at the input it reconstructs
+    def sublayer(i, which):
+        return hk.transform(lambda x: layer_init(i)[which](x))
 
-            x2 = y2 - g(y1)
-            x1 = y1 - f(x2)
+    sublayers = [(sublayer(i, 0), sublayer(i, 1)) for i in range(period)]
 
-            return jnp.concatenate((x1, x2), axis=-1)
+    return hk.transform(forward), sublayers
 
-        self.forward_fn = hk.transform(forward)
-        self.reverse_fn = hk.transform(reverse)
 
-        master_rng = jax.random.PRNGKey(random.getrandbits(32))
+# reconstructs the block input from its output and backprops dy through the block in a single pass, every f and g is
+# evaluated once (instead of a full reverse pass followed by a full forward pass under vjp)
+def reverse_grad(layer_init, period, params, y, dy):
+    _, sublayers = block_transforms(layer_init, period)
 
-        @functools.partial(jax.pmap, donate_argnums=0)
-        def forward_fn(x, params):
-            out = self.forward_fn.apply(params, None, x)
-            return out
+    grads = []
+    for f, g in reversed(sublayers):
+        hidden = y.shape[-1]
+        y1, y2 = y[:, :, :hidden // 2], y[:, :, hidden // 2:]
+        dy1, dy2 = dy[:, :, :hidden // 2], dy[:, :, hidden // 2:]
 
-        @functools.partial(jax.pmap, donate_argnums=(0, 1))
-        def reverse_fn(y_dy, acc, params):
-            y, dy = y_dy
-            reconstr_x = self.reverse_fn.apply(params, None, y)
+        # y2 = g(y1) + x2
+        g_y1, g_vjp = jax.vjp(lambda p, h: g.apply(p, None, h), params, y1)
+        x2 = y2 - g_y1
+        g_weights_grad, g_x_grad = g_vjp(dy2)
+        dx1 = dy1 + g_x_grad
+
+        # y1 = f(x2) + x1
+        f_x2, f_vjp = jax.vjp(lambda p, h: f.apply(p, None, h), params, x2)
+        x1 = y1 - f_x2
+        f_weights_grad, f_x_grad = f_vjp(dx1)
+        dx2 = dy2 + f_x_grad
+
+        grads += [g_weights_grad, f_weights_grad]
+        y = jnp.concatenate((x1, x2), axis=-1)
+        dy = jnp.concatenate((dx1, dx2), axis=-1)
+
+    # each grad is only nonzero for the params of its own f or g
+    return y, dy, functools.reduce(functools.partial(jax.tree_multimap, operator.add), grads)
+
+
+# the number of blocks comes from the leading axis of params, so stacks of any depth share this function
+# activations come in already in the compute dtype, so the donated input buffers match the outputs and can be reused
+@functools.partial(jax.pmap, donate_argnums=0, static_broadcasted_argnums=(2, 3, 4))
+def forward_fn(x, params, layer_init, period, compute):
+    forward, _ = block_transforms(layer_init, period)
+    compute = float_types[compute]
+
+    def block(h, block_params):
+        return forward.apply(block_params, None, h), None
+
+    out, _ = jax.lax.scan(block, x.astype(compute), cast_tree(params, compute))
+    return out
+
+
+@functools.partial(jax.pmap, donate_argnums=(0, 1), static_broadcasted_argnums=(3, 4, 5))
+def reverse_fn(y_dy, acc, params, layer_init, period, compute):
+    compute = float_types[compute]
+    y_dy = cast_tree(y_dy, compute)
 
-            _, vjpfun = jax.vjp(self.forward_fn.apply, params, None, reconstr_x)
-            weights_grad, _, x_grad = vjpfun(dy)
+    def block(carry, block_params):
+        y, dy = carry
+        reconstr_x, x_grad, weights_grad = reverse_grad(layer_init, period, block_params, y, dy)
 
-            new_acc = jax.tree_multimap(operator.add, acc, weights_grad)
-            return (reconstr_x, x_grad), new_acc
+        return (reconstr_x, x_grad), weights_grad
 
-        self.state = init_fn(master_rng, jnp.zeros_like(data), self.forward_fn.init, optimizer)
+    # walk the stack from the last block to the first, weights_grad comes out stacked in block order
+    x_dx, weights_grad = jax.lax.scan(block, y_dy, cast_tree(params, compute), reverse=True)
+
+    # float32 accumulator + compute dtype grads stays float32
+    new_acc = jax.tree_multimap(operator.add, acc, weights_grad)
+    return x_dx, new_acc
+
+
+@ray.remote(resources={"tpu": 1})
+class ReversibleLayer(object):
+    def __init__(
+            self,
+            layer_init: Callable,
+            layers: Sequence[int],
+            period: int,
+            data: jnp.ndarray,
+            optimizer: optax.GradientTransformation,
+            precision: NetworkPrecision
+    ):
+        assert len(layers) % period == 0, "layers must be a whole number of periods to be stacked"
+
+        self.layer_init = layer_init
+        self.layers = layers
+        self.period = period
+        self.optimizer = optimizer
+        self.precision = precision
+
+        data = dequantize(data, "float32")
+
+        forward, _ = block_transforms(layer_init, period)
+        num_blocks = len(layers) // period
+
+        def stacked_init(rng, x):
+            return jax.vmap(forward.init, in_axes=(0, None))(jax.random.split(rng, num_blocks), x)
+
+        master_rng = jax.random.PRNGKey(random.getrandbits(32))
+
+        self.state = init_fn(master_rng, jnp.zeros_like(data), stacked_init, optimizer)
         num_params = hk.data_structures.tree_size(self.state["params"])
         print(f'Param count = {num_params}')
 
-        self.forward = forward_fn
-        self.forward(jnp.zeros_like(data), self.state["params"])
+        # activations are handed over already in the compute dtype, warm up with the same signature
+        # forward_fn donates its input, so the reverse warm up runs on forward_fn's output instead of act
+        act = jnp.zeros_like(data, dtype=float_types[precision.compute])
+        out = forward_fn(act, self.state["params"], layer_init, period, precision.compute)
 
-        self.reverse = reverse_fn
-        _, new_acc = self.reverse((jnp.zeros_like(data), jnp.zeros_like(data)), self.state["grad_acc"],
-                                  self.state["params"])
-        self.state["grad_acc"] = new_acc
+        # warm up on a throwaway accumulator and don't apply the opt step so the initial state is kept as is
+        reverse_fn((out, jnp.zeros_like(out)), jax.tree_map(jnp.zeros_like, self.state["grad_acc"]),
+                   self.state["params"], layer_init, period, precision.compute)
 
-        self.state = opt_state(self.state, self.optimizer)
-        self.state = init_fn(master_rng, jnp.zeros_like(data), self.forward_fn.init, optimizer)
+        warm_opt(self.state, self.optimizer)
 
+        self.async_opt = AsyncOptimizer(self.optimizer)
+        self.checkpointer = AsyncCheckpointer()
         self.init = False
 
     def run(self):
         def forward(h, state):
-            return quantize(self.forward(dequantize(h, "float32"), state["params"]), self.precision.fwd_act)
+            out = forward_fn(dequantize(h, self.precision.compute), state["params"], self.layer_init, self.period,
+                             self.precision.compute)
+            return quantize(out, self.precision.fwd_act)
 
         def backward(y_dy, state):
             y, dy = y_dy
-            y_dy = (dequantize(y, "float32"), dequantize(dy, "float32"))
-            x_dx, new_acc = self.reverse(y_dy, state["grad_acc"], state["params"])
+            y_dy = (dequantize(y, self.precision.compute), dequantize(dy, self.precision.compute))
+            x_dx, new_acc = reverse_fn(y_dy, state["grad_acc"], state["params"], self.layer_init, self.period,
+                                       self.precision.compute)
             state["grad_acc"] = new_acc
             state["grad_count"] = state["grad_count"] + 1
 
@@ -116,22 +184,24 @@ class ReversibleLayer(object):
         self.bwd_q = Queue(2)
         self.init = True
 
-        run_threads(self.state, self.fwd_q, self.bwd_q, 2, forward, backward)
+        run_threads(self.state, self.fwd_q, self.bwd_q, forward, backward)
 
-    @ray.method(num_returns=2)
     def forward(self, h):
         while not self.init:
             time.sleep(0.1)
-        return run_function(self.fwd_q, h), None
+        return run_function(self.fwd_q, h)
 
-    @ray.method(num_returns=2)
     def backward(self, y_dy):
         while not self.init:
             time.sleep(0.1)
-        return run_function(self.bwd_q, y_dy), None
+        return run_function(self.bwd_q, y_dy)
+
+    def join_group(self, world_size, rank, group_name):
+        self.state = join_replica_group(self.state, world_size, rank, group_name)
+        self.async_opt.group = (world_size, group_name)
 
     def opt(self):
-        self.state = opt_state(self.state, self.optimizer)
+        self.state = self.async_opt.step(self.state)
 
     def get_params(self):
         return self.state["params"]
@@ -140,10 +210,17 @@ class ReversibleLayer(object):
         return self.state["grad_acc"]
 
     def save(self, path, epoch):
-        save_checkpoint(self.state, path, epoch)
+        # saves the params the last batch ran with, applying the in flight step here would put this replica a step
+        # ahead of the other replicas of the stage
+        self.checkpointer.save(self.state, path, epoch)
+
+    # blocks until the last save is written, raising its error if it failed
+    def flush(self):
+        self.checkpointer.wait()
 
     def load(self, path):
-        ckpt = load_checkpoint(path)
+        self.checkpointer.wait()
+        ckpt = restore_checkpoint(path, self.state)
 
         if ckpt:
             self.state = ckpt
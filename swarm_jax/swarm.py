@@ -4,7 +4,7 @@ import numpy as np
 import optax
 import ray
 from tensorboardX import SummaryWriter
-from typing import Callable
+from typing import Callable, Optional
 
 from .embedding_layer import EmbeddingLayer, ProjLayer
 from .model import SwarmModel
@@ -12,13 +12,22 @@ from .reversible_layer import ReversibleLayer
 from .swarm_layer import NetworkPrecision
 
 
+max_in_flight = 16  # have max 16 concurrent examples in the network
+
+# each in flight example can have a forward and a backward call queued in every actor, keep enough threads for all of
+# them plus opt/save/load
+actor_concurrency = 2 * max_in_flight + 8
+
+
 class Swarm:
     def __init__(self,
                  model: SwarmModel,
                  optimizer: optax.GradientTransformation,
                  loss_scale: float,
                  dataloader: Callable,
-                 precision: NetworkPrecision):
+                 precision: NetworkPrecision,
+                 layers_per_actor: Optional[int] = None,
+                 replicas: int = 1):
         self.model = model
         self.optimizer = optax.chain(
             optax.scale(1 / loss_scale),
@@ -27,82 +36,146 @@ class Swarm:
         self.dataloader = dataloader
         self.minibatches = 1
         self.loss_scale = loss_scale
+        self.replicas = replicas
 
         assert ray.is_initialized()  # needs a valid ray cluster to start
 
+        # every stage (embedding, each group of reversible layers, projection) is a list of data parallel replicas
         example = self.dataloader()
-        self.embedding = EmbeddingLayer.options(max_concurrency=8).remote(example["obs"], self.model.vocab,
-                                                                          self.model.d_model, self.optimizer, precision)
-        self.embedding.run.remote()
-
-        x, _ = self.embedding.embed_forward.remote(example["obs"])
-
-        self.proj = ProjLayer.options(max_concurrency=8).remote(x, self.model.vocab, self.model.d_model, self.optimizer,
-                                                                self.loss_scale, precision)
-        self.proj.run.remote()
+        self.embedding = [
+            EmbeddingLayer.options(max_concurrency=actor_concurrency).remote(
+                example["obs"], self.model.vocab, self.model.d_model, self.optimizer, precision)
+            for _ in range(replicas)
+        ]
+
+        for e in self.embedding:
+            e.run.remote()
+
+        x = self.embedding[0].embed_forward.remote(example["obs"])
+
+        self.proj = [
+            ProjLayer.options(max_concurrency=actor_concurrency).remote(
+                x, self.model.vocab, self.model.d_model, self.optimizer, self.loss_scale, precision)
+            for _ in range(replicas)
+        ]
+
+        # contiguous groups of reversible layers run as a single scan inside one actor, only the activations at
+        # group boundaries go through ray (by default the whole stack is one group)
+        layers_per_actor = layers_per_actor or self.model.rev_layers
+        # every group holds whole blocks, a shorter last group could end in a partial one
+        assert layers_per_actor % self.model.rev_period == 0
+        assert self.model.rev_layers % layers_per_actor == 0
 
         self.layers = []
-        for i in range(model.rev_layers):
-            self.layers.append(
-                ReversibleLayer.options(max_concurrency=8).remote(self.model.rev_init, i, x, self.optimizer, precision))
-
-        for l in self.layers:
-            l.run.remote()
-
-        self.all_layers = [self.embedding] + self.layers + [self.proj]
+        layer_names = []
+        for i in range(0, self.model.rev_layers, layers_per_actor):
+            group = range(i, i + layers_per_actor)
+            layer_names.append(f"layers_{group.start}-{group.stop - 1}")
+            self.layers.append([
+                ReversibleLayer.options(max_concurrency=actor_concurrency).remote(
+                    self.model.rev_init, group, self.model.rev_period, x, self.optimizer, precision)
+                for _ in range(replicas)
+            ])
+
+        self.stages = [self.embedding] + self.layers + [self.proj]
+
+        # checkpoints are stored per stage under these names, so a different stage layout can't load the wrong state
+        self.stage_names = ["embedding"] + layer_names + ["proj"]
+
+        for stage in self.stages[1:]:
+            for l in stage:
+                l.run.remote()
+
+        # replicas of a stage average their gradients with an allreduce before each optimizer step
+        if replicas > 1:
+            joins = [l.join_group.remote(replicas, r, f"stage_{i}")
+                     for i, stage in enumerate(self.stages) for r, l in enumerate(stage)]
+            ray.get(joins)
 
     def run(self, epochs, log_path, ckpt_path):
         assert ray.is_initialized()  # needs a valid ray cluster
         writer = SummaryWriter(log_path, flush_secs=5)
 
-        ckpt_loads = [layer.load.remote(f"{ckpt_path}/{i}/") for i, layer in enumerate(self.all_layers)]
+        ckpt_loads = [l.load.remote(f"{ckpt_path}/{name}/") for name, stage in zip(self.stage_names, self.stages)
+                      for l in stage]
         print(f"checkpoint load status: {ray.get(ckpt_loads)}")
 
-        pool = ThreadPool(16)  # have max 16 concurrent examples in the network
+        pool = ThreadPool(max_in_flight)
+        opts = []
+        ckpt_flushes = []
 
         for e in range(epochs):
+            # the previous step's opt calls are in flight while the next batch is loaded, every actor has to have
+            # taken its step before any microbatch of this batch (or a save) reaches it
+            data = [self.dataloader() for _ in range(self.replicas)]
+            ray.wait(opts, num_returns=len(opts))
+
+            # checkpoints are written on the actors' background threads, report one once all of its writes are done
+            # (ray.get raises if one of them failed)
+            if ckpt_flushes:
+                _, unwritten = ray.wait(ckpt_flushes, num_returns=len(ckpt_flushes), timeout=0)
+
+                if not unwritten or e % 5000 == 0:
+                    ray.get(ckpt_flushes)
+                    ckpt_flushes = []
+                    print("checkpoint saved")
+
             if e % 5000 == 0:
-                ckpt_saves = [layer.save.remote(f"{ckpt_path}/{i}/", e) for i, layer in enumerate(self.all_layers)]
+                # replicas hold the same params, the first one of each stage saves
+                ckpt_saves = [stage[0].save.remote(f"{ckpt_path}/{name}/", e)
+                              for name, stage in zip(self.stage_names, self.stages)]
                 ray.wait(ckpt_saves, num_returns=len(ckpt_saves))
+                ckpt_flushes = [stage[0].flush.remote() for stage in self.stages]
 
-                print(f"checkpoint saved")
-
-            data = self.dataloader()
+                print("checkpoint queued")
 
-            def map_fn(_):
-                return drive_example(self, data)
+            def map_fn(i):
+                replica = i % self.replicas
+                return drive_example(self, data[replica], replica)
 
             result = list(pool.imap_unordered(map_fn, range(32)))  # 32 microbatches per batch
             result = np.array(result)
             error, cos_err, loss = result.mean(axis=(0, 2))
 
-            opts = [layers.opt.remote() for layers in self.all_layers]
-            ray.wait(opts, num_returns=len(opts))
+            opts = [l.opt.remote() for stage in self.stages for l in stage]
 
             writer.add_scalar("loss", loss / self.loss_scale, e)
             writer.add_scalar("reconstruction_error", error, e)
             writer.add_scalar("reconstruction_cos_error", cos_err, e)
             print(e, loss / self.loss_scale)
 
+        ray.wait(opts, num_returns=len(opts))
+
+        # don't let the process exit before the last checkpoint is on disk
+        if ckpt_flushes:
+            ray.get(ckpt_flushes)
+            print("checkpoint saved")
+
+
+# take a training example and shoves it through forward and backward of all layers of one replica
+# the whole chain is submitted at once, the object refs carry the dependencies between layers so each layer starts
+# as soon as its input is ready
+# refs are passed as plain arguments so ray resolves them before the call starts: the object is fetched straight into
+# the receiving actor's object store and the call doesn't hold an actor thread while waiting for it
+# Nothing here waits between hops, so the ordering relies on ray only dispatching an actor call once its arguments are
+# resolved. A dispatched call then holds an actor thread until the actor's run thread gets to it, so every actor needs
+# a thread for each forward and backward call that can be in flight at once (actor_concurrency), or they deadlock.
+def drive_example(swarm: Swarm, data, replica: int = 0):
+    embedding = swarm.embedding[replica]
+    layers = [stage[replica] for stage in swarm.layers]
+    proj = swarm.proj[replica]
 
-# take a training example and shoves it through forward and backward of all layers
-def drive_example(swarm: Swarm, data):
-    x, x_wait = swarm.embedding.embed_forward.remote(data["obs"])
-    ray.wait([x_wait])
+    x = embedding.embed_forward.remote(data["obs"])
 
-    # wrap all big ray objects in unit tuples to stop implicit .get
-    for l in swarm.layers:
-        x, x_wait = l.forward.remote((x,))
-        ray.wait([x_wait])
+    for l in layers:
+        x = l.forward.remote(x)
 
-    y_dy, loss = swarm.proj.debed_grad.remote((x,), data["target"])
-    ray.wait([loss])
+    y_dy, loss = proj.debed_grad.remote(x, data["target"])
 
-    for l in reversed(swarm.layers):
-        y_dy, y_dy_wait = l.backward.remote((y_dy,))
-        ray.wait([y_dy_wait])
+    for l in reversed(layers):
+        y_dy = l.backward.remote(y_dy)
 
-    error = swarm.embedding.embed_grad.remote(data["obs"], (y_dy,))
+    error = embedding.embed_grad.remote(data["obs"], y_dy)
     ray.wait([error])
 
     ret = ray.get(error) + (ray.get(loss),)
@@ -1,21 +1,23 @@
 """
 Common methods for layer actors
 """
+import os
 import pickle
 import re
 from functools import partial
 from pathlib import Path
 from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 
 import jax
 import jax.numpy as jnp
 import numpy as np
 import optax
-import ray
 from dataclasses import dataclass
+from ray.util import collective
 from glob import glob
-from typing import Callable
+from typing import Callable, Optional, Tuple
 
 
 # TODO: more intellegent checkpoint saving with deleting old checkpoints etc
@@ -23,8 +25,31 @@ def save_checkpoint(state, path, epoch):
     Path(path).mkdir(parents=True, exist_ok=True)
 
     save_file = Path(path, f"ckpt_{epoch:06}.pkl")
-    f = open(save_file, "wb")
-    pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_file = Path(path, f"ckpt_{epoch:06}.pkl.tmp")
+
+    # write then rename, so a save that is still in flight (or interrupted) is never picked up by load_checkpoint
+    with open(tmp_file, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, save_file)
+
+
+# Writes checkpoints on a background thread. The state is copied to host memory first so the actor can carry on
+# training while the file is written, and only one save is in flight at a time.
+class AsyncCheckpointer(object):
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def save(self, state, path, epoch):
+        self.wait()
+
+        host_state = jax.device_get(state)
+        self.pending = self.executor.submit(save_checkpoint, host_state, path, epoch)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
 
 
 def load_checkpoint(path):
@@ -39,37 +64,130 @@ def load_checkpoint(path):
     return None
 
 
-# @partial(jax.jit, donate_argnums=(0, 1, 2), static_argnums=3)
-@partial(jax.jit, static_argnums=3)
-def opt_jit(grad_acc, opt_state, params, optimizer):
-    total_grad = jax.tree_map(lambda x: jnp.mean(x, axis=0), grad_acc)
+# loads the latest checkpoint in path, refusing one whose params don't have the same names and shapes as state's
+def restore_checkpoint(path, state):
+    ckpt = load_checkpoint(path)
 
-    cpu_device = jax.devices("cpu")[0]
+    if ckpt is None:
+        return None
+
+    def layout(params):
+        return jax.tree_structure(params), [np.shape(x) for x in jax.tree_leaves(params)]
 
-    total_grad = jax.device_put(total_grad, device=cpu_device)
-    cpu_params = jax.device_put(jax.tree_map(lambda x: x[0], params), device=cpu_device)
+    if layout(ckpt["params"]) != layout(state["params"]):
+        raise ValueError(f"checkpoint in {path} does not match the layer's parameters")
 
+    return ckpt
+
+
+# runs on the host, where the optimizer state lives
+@partial(jax.jit, static_argnums=3, backend="cpu")
+def opt_jit(total_grad, opt_state, params, optimizer):
     updates, new_opt_state = optimizer.update(total_grad, opt_state)
 
-    new_params = optax.apply_updates(cpu_params, updates)
+    new_params = optax.apply_updates(params, updates)
+    return new_opt_state, new_params
+
+
+# mean of the per device accumulators, taken on the accelerators so only one copy of the gradients crosses PCI-e
+@partial(jax.pmap, axis_name="devices")
+def device_mean(grad_acc):
+    return jax.lax.pmean(grad_acc, "devices")
 
-    new_grad_acc = jax.tree_map(jnp.zeros_like, grad_acc)
-    return new_grad_acc, new_opt_state, new_params
 
+def opt_inputs(state):
+    total_grad = jax.tree_map(lambda x: x[0], device_mean(state["grad_acc"]))
 
-def opt_state(state, optimizer):
-    new_grad_acc, new_opt_state, new_params = opt_jit(state["grad_acc"],
-                                                      state["opt_state"],
-                                                      state["params"],
-                                                      optimizer)
+    # start the device to host copies now so they overlap with whatever runs before opt_jit picks them up
+    for g in jax.tree_leaves(total_grad):
+        g.copy_to_host_async()
 
-    state["grad_acc"] = new_grad_acc
+    # params are replicated across devices, only one copy needs to go to the host
+    return total_grad, state["opt_state"], jax.tree_map(lambda x: x[0], state["params"])
+
+
+def apply_opt(state, new_opt_state, new_params):
     state["opt_state"] = new_opt_state
     state["params"] = jax.device_put_replicated(new_params, jax.local_devices())
+    return state
+
+
+def reset_grad_acc(state):
+    state["grad_acc"] = jax.tree_map(jnp.zeros_like, state["grad_acc"])
     state["grad_count"] = np.array(0)
     return state
 
 
+# compile the optimizer step without applying its result to state
+def warm_opt(state, optimizer):
+    jax.tree_map(lambda x: x.block_until_ready(), opt_jit(*opt_inputs(state), optimizer))
+
+
+# Joins the collective group of the replicas of one stage (each replica calls this with its own rank) and starts every
+# replica from rank 0's params.
+def join_replica_group(state, world_size: int, rank: int, group_name: str):
+    collective.init_collective_group(world_size, rank, backend="gloo", group_name=group_name)
+
+    def broadcast(x):
+        x = np.array(x[0])
+        collective.broadcast(x, src_rank=0, group_name=group_name)
+        return x
+
+    params = jax.tree_map(broadcast, state["params"])
+    state["params"] = jax.device_put_replicated(params, jax.local_devices())
+    return state
+
+
+# Mean of a gradient tree over the replicas of a stage. tree is already the mean over the local devices (one copy of
+# the gradients), its leaves are packed into one host buffer so the ring allreduce runs once per step.
+def allreduce_mean(tree, world_size: int, group_name: str):
+    leaves, treedef = jax.tree_flatten(tree)
+    flat = np.concatenate([np.ravel(np.asarray(x, dtype=np.float32)) for x in leaves])
+
+    collective.allreduce(flat, group_name=group_name)
+    flat /= world_size
+
+    offsets = np.cumsum([np.size(x) for x in leaves])[:-1]
+    reduced = [x.reshape(np.shape(l)) for x, l in zip(np.split(flat, offsets), leaves)]
+    return jax.tree_unflatten(treedef, reduced)
+
+
+# Runs the optimizer step on a background thread so the actor (and the accelerator) is not blocked on the host side
+# update. A step is only applied to the params at the start of the next step, so every batch runs with one consistent
+# set of params (needed for activation reconstruction), which is one step stale.
+# When the stage is replicated the gradients are averaged over the replicas first, all replicas call step together.
+class AsyncOptimizer(object):
+    def __init__(self, optimizer: optax.GradientTransformation):
+        self.optimizer = optimizer
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.group: Optional[Tuple[int, str]] = None
+
+    def step(self, state):
+        state = self.wait(state)
+
+        inputs = opt_inputs(state)
+        state = reset_grad_acc(state)
+
+        self.pending = self.executor.submit(self.update, *inputs)
+        return state
+
+    def update(self, total_grad, opt_state, params):
+        if self.group is not None:
+            total_grad = allreduce_mean(total_grad, *self.group)
+
+        return opt_jit(total_grad, opt_state, params, self.optimizer)
+
+    # apply the in flight step, if there is one
+    def wait(self, state):
+        if self.pending is not None:
+            new_opt_state, new_params = self.pending.result()
+            self.pending = None
+
+            state = apply_opt(state, new_opt_state, new_params)
+        return state
+
+
 # @partial(jax.jit)
 def init_fn(master_rng, data, init_fn, optimizer):
     out_rng, init_rng = jax.random.split(master_rng)
@@ -93,27 +211,6 @@ def init_fn(master_rng, data, init_fn, optimizer):
         params=params)
 
 
-# Thread to overlap remote transfers with computation (with bounded memory usage)
-# TODO: have hierarchy of remote -> RAM -> accelerator memory to overlap PCI-e transfer with computation
-class GetThread(Thread):
-    def __init__(self, in_queue: Queue, out_queue: Queue):
-        super().__init__()
-        self.i_q = in_queue
-        self.o_q = out_queue
-
-    def run(self):
-        while True:
-            ret_q, obj_id, *aux = self.i_q.get()
-
-            if isinstance(obj_id, ray.ObjectID):
-                # GIL released here
-                o = ray.get(obj_id)
-            else:
-                o = obj_id
-
-            self.o_q.put((ret_q, o, *aux))
-
-
 # TODO: bound the number of pending outputs when layerdrop is added, currently equal to number of pending inputs
 class RunThread(Thread):
     def __init__(self, fwd_q: Queue, bwd_q: Queue, fwd_fn: Callable, bwd_fn: Callable):
@@ -145,17 +242,12 @@ class RunThread(Thread):
                 pass
 
 
-# create a get thread for both fwd and bwd as well as a run thread (blocks forever)
-def run_threads(state, fwd_in_q: Queue, bwd_in_q: Queue, queue_size: int, fwd_fn: Callable, bwd_fn: Callable):
-    fwd_out_q = Queue(queue_size)
-    bwd_out_q = Queue(queue_size)
-
-    fwd_get = GetThread(fwd_in_q, fwd_out_q)
-    bwd_get = GetThread(bwd_in_q, bwd_out_q)
-    run = RunThread(fwd_out_q, bwd_out_q, partial(fwd_fn, state=state), partial(bwd_fn, state=state))
+# Create the run thread that serves fwd and bwd calls (blocks forever). Ray resolves the calls' object refs before they
+# start, so inputs arrive in the queues already fetched, the bounded queues keep at most a few of them waiting here.
+# TODO: have hierarchy of remote -> RAM -> accelerator memory to overlap PCI-e transfer with computation
+def run_threads(state, fwd_q: Queue, bwd_q: Queue, fwd_fn: Callable, bwd_fn: Callable):
+    run = RunThread(fwd_q, bwd_q, partial(fwd_fn, state=state), partial(bwd_fn, state=state))
 
-    fwd_get.start()
-    bwd_get.start()
     run.start()
 
     run.join()
@@ -175,15 +267,18 @@ def function_wrapper(fun):
 # runs a function via queue (blocking, run in threadpool)
 def run_function(q: Queue, obj_id, *aux):
     ret_q = Queue(1)
-
-    if isinstance(obj_id, tuple):
-        q.put((ret_q, obj_id[0], *aux))
-    else:
-        q.put((ret_q, obj_id, *aux))
+    q.put((ret_q, obj_id, *aux))
 
     return ret_q.get()
 
 
+float_types = {
+    "float16": jnp.float16,
+    "bfloat16": jnp.bfloat16,
+    "float32": jnp.float32,
+}
+
+
 @partial(jax.jit, static_argnums=2)
 def int_quantize_jit(x: jnp.ndarray, max_int: int, to_type: str):
     min = x.min(axis=1, keepdims=True)
@@ -197,23 +292,25 @@ def int_quantize_jit(x: jnp.ndarray, max_int: int, to_type: str):
 
 
 def quantize(x: jnp.ndarray, to_type: str):
-    assert to_type in ["float16", "float32", "uint16", "uint8"]
+    assert to_type in ["float16", "bfloat16", "float32", "uint16", "uint8"]
 
     if "int" in to_type:
         max_int = 2 ** 8 - 1 if to_type == "uint8" else 2 ** 16 - 1
         return to_type, int_quantize_jit(x, max_int, to_type)
     else:
-        return to_type, x.astype(to_type)
+        return to_type, x.astype(float_types[to_type])
 
 
 @partial(jax.jit, static_argnums=4)
 def int_dequantize_jit(x: jnp.ndarray, scale: jnp.ndarray, offset: jnp.ndarray, max_int: int, to_type: str):
-    return x.astype(to_type) * scale.astype(to_type) / max_int + offset.astype(to_type)
+    # rescale in float32 and only round once to the target type
+    x = x.astype(jnp.float32) * scale.astype(jnp.float32) / max_int + offset.astype(jnp.float32)
+    return x.astype(float_types[to_type])
 
 
 def dequantize(x, to_type: str):
     from_type, data = x
-    assert from_type in ["float16", "float32", "uint16", "uint8"]
+    assert from_type in ["float16", "bfloat16", "float32", "uint16", "uint8"]
 
     if "int" in from_type:
         offset, scale, data = data
@@ -221,19 +318,24 @@ def dequantize(x, to_type: str):
 
         return int_dequantize_jit(data, scale, offset, max_int, to_type)
     else:
-        return data.astype(to_type)
+        return data.astype(float_types[to_type])
+
+
+def cast_tree(tree, dtype):
+    return jax.tree_map(lambda x: x.astype(dtype), tree)
 
 
+# activations and gradients are sent between layers in bfloat16 and layers compute in bfloat16, while params and
+# optimizer state stay in float32
 @dataclass
 class NetworkPrecision:
-    fwd_act: str
-    rev_act: str
-    grad: str
+    fwd_act: str = "bfloat16"
+    rev_act: str = "bfloat16"
+    grad: str = "bfloat16"
+    compute: str = "bfloat16"
 
 
 if __name__ == "__main__":
-    import os
-
     os.environ["XLA_FLAGS"] = "--xla_gpu_cuda_data_dir=/opt/cuda-10.1"
 
     rng = jax.random.PRNGKey(0)
@@ -252,6 +354,10 @@ if __name__ == "__main__":
     d = dequantize(q, "float32")
     assert jnp.allclose(r, d, atol=1e-3, rtol=1e-3)
 
+    q = quantize(r, "bfloat16")
+    d = dequantize(q, "float32")
+    assert jnp.allclose(r, d, atol=1e-1, rtol=1e-2)
+
     q = quantize(r, "float32")
     d = dequantize(q, "float32")
     assert jnp.allclose(r, d)
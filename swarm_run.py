@@ -22,7 +22,7 @@ optimizer = optax.chain(
     optax.clip_by_global_norm(0.25),
     optax.adam(2e-4, b1=0.9, b2=0.99, eps=1e-5))
 
-prec = NetworkPrecision(fwd_act="uint16", rev_act="uint16", grad="uint16")
+prec = NetworkPrecision(fwd_act="uint16", rev_act="uint16", grad="uint16", compute="float32")
 
 model = SwarmCharTransformer
 swarm = Swarm(model, optimizer, 2 ** 16, train_dataset.get_samples, prec)
@@ -5,7 +5,7 @@ import optax
 import ray
 
 from loader import TextLoader
-from ray_tpu import start_ray, get_connection, create_tpu, wait_til
+from ray_tpu import start_ray, get_connection, create_tpu, wait_til_many
 from swarm_jax.model import SwarmCharTransformerBig
 from swarm_jax.swarm import Swarm
 from swarm_jax.swarm_layer import NetworkPrecision
@@ -24,8 +24,8 @@ conns = []
 for i in range(tpus):
     create_tpu(f"swarm-jax-test-{i}", "europe-west4-a", "v3-8", False)
 
-for i in range(tpus):
-    assert wait_til(f"swarm-jax-test-{i}", "europe-west4-a", {'state': 'READY', 'health': 'HEALTHY'})
+assert wait_til_many([f"swarm-jax-test-{i}" for i in range(tpus)], "europe-west4-a",
+                     {'state': 'READY', 'health': 'HEALTHY'})
 
 for i in range(tpus):
     conns += get_connection(f"swarm-jax-test-{i}", "europe-west4-a")
@@ -39,10 +39,10 @@ optimizer = optax.chain(
     optax.clip_by_global_norm(0.25),
     optax.adam(2e-4, b1=0.9, b2=0.99, eps=1e-5))
 
-prec = NetworkPrecision(fwd_act="float32", rev_act="float32", grad="float32")
+prec = NetworkPrecision(fwd_act="bfloat16", rev_act="bfloat16", grad="bfloat16", compute="bfloat16")
 
 model = SwarmCharTransformerBig
-swarm = Swarm(model, optimizer, 2 ** 16, train_dataset.get_samples, prec)
+swarm = Swarm(model, optimizer, 2 ** 16, train_dataset.get_samples, prec, replicas=2)
 swarm.run(100000, "runs/512_30L", "ckpt/512_30L")
 
 ray.shutdown()